@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Rate-limit-aware scheduling for paid image APIs
+Pools several keys per provider behind token buckets and concurrency limits,
+queues requests instead of failing when over quota and honors Retry-After
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+# Conservative default limits per provider, override with <PREFIX>_RPM / _CONCURRENCY / _BURST
+PROVIDER_LIMITS = {
+    'stability': {'env': 'STABILITY_API_KEY', 'rpm': 60, 'concurrency': 4},
+    'openai': {'env': 'OPENAI_API_KEY', 'rpm': 5, 'concurrency': 2},
+    'replicate': {'env': 'REPLICATE_API_TOKEN', 'rpm': 60, 'concurrency': 4},
+    'together': {'env': 'TOGETHER_API_TOKEN', 'rpm': 60, 'concurrency': 4},
+    'fal': {'env': 'FAL_KEY', 'rpm': 60, 'concurrency': 4},
+}
+
+# Longest a request waits in the queue before the caller falls back to another provider
+MAX_QUEUE_WAIT = float(os.environ.get('SCHEDULER_MAX_QUEUE_WAIT', 300))
+
+# Times a request is requeued after 429 responses before giving up
+MAX_THROTTLE_RETRIES = 3
+
+# Cool-down used when a 429 response carries no usable Retry-After header
+DEFAULT_RETRY_AFTER = 10.0
+
+class RateLimited(Exception):
+    """Raised by a job when the provider answered 429"""
+
+    def __init__(self, retry_after=None):
+        super().__init__(f"Rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+def retry_after_seconds(response):
+    """Parses a Retry-After header given as seconds or an HTTP date"""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def raise_for_rate_limit(response):
+    """Turns a 429 response into RateLimited so the scheduler can requeue the job"""
+    if response.status_code == 429:
+        raise RateLimited(retry_after_seconds(response))
+
+class KeySlot:
+    """Token bucket, concurrency counter and usage statistics for one API key"""
+
+    def __init__(self, key, rpm, burst, concurrency):
+        self.key = key
+        self.rate = rpm / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.updated = time.monotonic()
+
+        self.requests = 0
+        self.throttled = 0
+        self.busy_seconds = 0.0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self, now):
+        """Seconds until this key may start another request, 0 when it can start now"""
+        self.refill(now)
+        if self.in_flight >= self.concurrency:
+            return None
+        waits = [self.cooldown_until - now, (1.0 - self.tokens) / self.rate if self.tokens < 1.0 else 0.0]
+        return max(0.0, *waits)
+
+class ProviderScheduler:
+    """Distributes one provider's requests across its keys within their rate limits"""
+
+    def __init__(self, name, keys, rpm, concurrency, burst=None, max_queue_wait=MAX_QUEUE_WAIT):
+        self.name = name
+        self.max_queue_wait = max_queue_wait
+        self.started = time.monotonic()
+        self.condition = threading.Condition()
+        self.slots = [
+            KeySlot(key, rpm, burst or max(1, rpm // 4), concurrency)
+            for key in keys
+        ]
+
+    def has_keys(self):
+        return bool(self.slots)
+
+    def acquire(self):
+        """Blocks until some key has a token and a free concurrency slot, returns that key's slot"""
+        if not self.slots:
+            raise Exception(f"No API keys configured for {self.name}")
+
+        queued_at = time.monotonic()
+        deadline = queued_at + self.max_queue_wait
+
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                waits = [(slot.ready_in(now), slot) for slot in self.slots]
+                ready = [(wait, slot) for wait, slot in waits if wait == 0.0]
+
+                if ready:
+                    # Prefer the least loaded key with the fullest bucket
+                    slot = min(ready, key=lambda item: (item[1].in_flight, -item[1].tokens))[1]
+                    slot.tokens -= 1.0
+                    slot.in_flight += 1
+                    slot.requests += 1
+
+                    queued = now - queued_at
+                    slot.queue_seconds += queued
+                    slot.max_queue_seconds = max(slot.max_queue_seconds, queued)
+                    return slot
+
+                if now >= deadline:
+                    raise Exception(f"{self.name} queue wait exceeded {self.max_queue_wait}s")
+
+                # Sleep until the earliest key frees up; releases notify earlier
+                timed = [wait for wait, _ in waits if wait is not None]
+                self.condition.wait(min([deadline - now] + timed))
+
+    def release(self, slot, started, retry_after=None):
+        with self.condition:
+            slot.in_flight -= 1
+            slot.busy_seconds += time.monotonic() - started
+            if retry_after is not None:
+                slot.throttled += 1
+                slot.cooldown_until = max(slot.cooldown_until, time.monotonic() + retry_after)
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Holds one key for the duration of a request or a whole polling job"""
+        slot = self.acquire()
+        started = time.monotonic()
+        retry_after = None
+        try:
+            yield slot
+        except RateLimited as e:
+            retry_after = e.retry_after if e.retry_after is not None else DEFAULT_RETRY_AFTER
+            raise
+        finally:
+            self.release(slot, started, retry_after)
+
+    def run(self, job):
+        """
+        Calls job(key) under the pool's limits. A job that raises RateLimited is
+        requeued after its key cools down for the Retry-After period.
+        """
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            try:
+                with self.slot() as slot:
+                    return job(slot.key)
+            except RateLimited as e:
+                print(f"{self.name} key ...{slot.key[-4:]} rate limited (attempt {attempt + 1}): {e}")
+
+        raise Exception(f"{self.name} still rate limited after {MAX_THROTTLE_RETRIES + 1} attempts")
+
+    def report(self):
+        """Per-key utilization and queue time"""
+        with self.condition:
+            now = time.monotonic()
+            elapsed = max(now - self.started, 1e-9)
+            keys = []
+            for slot in self.slots:
+                slot.refill(now)
+                keys.append({
+                    'key': f"...{slot.key[-4:]}",
+                    'requests': slot.requests,
+                    'throttled': slot.throttled,
+                    'in_flight': slot.in_flight,
+                    'tokens': round(slot.tokens, 2),
+                    'utilization': round(slot.busy_seconds / (elapsed * slot.concurrency), 4),
+                    'avg_queue_seconds': round(slot.queue_seconds / slot.requests, 3) if slot.requests else 0.0,
+                    'max_queue_seconds': round(slot.max_queue_seconds, 3),
+                    'cooling_down': slot.cooldown_until > now
+                })
+            return {'provider': self.name, 'keys': keys}
+
+def load_keys(env_name):
+    """Reads keys from <ENV>S and <ENV>, both accepting comma-separated lists"""
+    keys = []
+    for name in (f"{env_name}S", env_name):
+        for key in os.environ.get(name, '').split(','):
+            key = key.strip()
+            if key and key not in keys:
+                keys.append(key)
+    return keys
+
+def create_scheduler(provider):
+    """Builds a provider's scheduler from its environment keys and limits"""
+    limits = PROVIDER_LIMITS[provider]
+    prefix = provider.upper()
+    rpm = int(os.environ.get(f"{prefix}_RPM", limits['rpm']))
+    concurrency = int(os.environ.get(f"{prefix}_CONCURRENCY", limits['concurrency']))
+    burst = os.environ.get(f"{prefix}_BURST")
+
+    return ProviderScheduler(
+        provider,
+        load_keys(limits['env']),
+        rpm,
+        concurrency,
+        burst=int(burst) if burst else None
+    )
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(provider):
+    """Process-wide scheduler for a provider"""
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            _schedulers[provider] = create_scheduler(provider)
+        return _schedulers[provider]
+
+def scheduler_report(providers):
+    """Utilization report for the given providers"""
+    return [get_scheduler(provider).report() for provider in providers]
@@ -6,12 +6,12 @@ Perfect for commercial video generation at scale
 """
 
 import json
-import base64
-import io
 import os
 import random
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from api_scheduler import get_scheduler, raise_for_rate_limit, scheduler_report
+from image_transcode import encode_generated_image, fetch_image, ingest_image, output_options
 
 app = Flask(__name__)
 CORS(app)
@@ -30,14 +30,14 @@ def initialize_sdxl_pipeline():
     apis_available = []
     
     # Check Stability AI (professional grade)
-    stability_key = os.getenv('STABILITY_API_KEY')
-    if stability_key:
-        apis_available.append("Stability AI")
+    stability_keys = len(get_scheduler('stability').slots)
+    if stability_keys:
+        apis_available.append(f"Stability AI ({stability_keys} keys)")
     
     # Check OpenAI DALL-E (high quality)
-    openai_key = os.getenv('OPENAI_API_KEY') 
-    if openai_key:
-        apis_available.append("OpenAI DALL-E")
+    openai_keys = len(get_scheduler('openai').slots)
+    if openai_keys:
+        apis_available.append(f"OpenAI DALL-E ({openai_keys} keys)")
     
     if apis_available:
         print(f"Commercial APIs available: {', '.join(apis_available)}")
@@ -46,30 +46,32 @@ def initialize_sdxl_pipeline():
         print("No commercial APIs configured. Using demo mode.")
         return False
 
-def generate_with_professional_apis(prompt):
+def generate_with_professional_apis(prompt, output):
     """Generate with professional commercial APIs - no content restrictions"""
     
+    # Requests are queued per provider and spread over its key pool within rate limits
+    
     # Try Stability AI first (commercial grade, no filters)
-    stability_key = os.getenv('STABILITY_API_KEY')
-    if stability_key:
+    stability = get_scheduler('stability')
+    if stability.has_keys():
         try:
-            return generate_with_stability_ai(prompt, stability_key)
+            return stability.run(lambda api_key: generate_with_stability_ai(prompt, api_key, output))
         except Exception as e:
             print(f"Stability AI error: {e}")
     
     # Try OpenAI DALL-E as backup (high quality)
-    openai_key = os.getenv('OPENAI_API_KEY')
-    if openai_key:
+    openai = get_scheduler('openai')
+    if openai.has_keys():
         try:
-            return generate_with_dalle(prompt, openai_key)
+            return openai.run(lambda api_key: generate_with_dalle(prompt, api_key, output))
         except Exception as e:
             print(f"OpenAI error: {e}")
     
     # No valid APIs available
     raise Exception("No commercial image generation APIs configured. Please provide STABILITY_API_KEY or OPENAI_API_KEY.")
 
-def generate_with_stability_ai(prompt, api_key):
-    """Generate with Stability AI SDXL - commercial grade"""
+def generate_with_stability_ai(prompt, api_key, output):
+    """Generate with Stability AI SDXL - commercial grade (PNG only, transcoded on ingest)"""
     import requests
     
     response = requests.post(
@@ -91,16 +93,17 @@ def generate_with_stability_ai(prompt, api_key):
         },
         timeout=60
     )
+    raise_for_rate_limit(response)
     
     if response.status_code == 200:
         data = response.json()
         image_data = data["artifacts"][0]["base64"]
-        return f"data:image/png;base64,{image_data}"
+        return ingest_image(image_data, output)
     else:
         raise Exception(f"Stability AI API error: {response.status_code}")
 
-def generate_with_dalle(prompt, api_key):
-    """Generate with OpenAI DALL-E - high quality"""
+def generate_with_dalle(prompt, api_key, output):
+    """Generate with OpenAI DALL-E - high quality (PNG only, transcoded on ingest)"""
     import requests
     
     response = requests.post(
@@ -119,19 +122,19 @@ def generate_with_dalle(prompt, api_key):
         },
         timeout=60
     )
+    raise_for_rate_limit(response)
     
     if response.status_code == 200:
         data = response.json()
         image_url = data["data"][0]["url"]
         
         # Download and convert to base64
-        img_response = requests.get(image_url)
-        img_base64 = base64.b64encode(img_response.content).decode()
-        return f"data:image/png;base64,{img_base64}"
+        image_bytes, fetch_ms = fetch_image(image_url)
+        return ingest_image(image_bytes, output, fetch_ms)
     else:
         raise Exception(f"OpenAI API error: {response.status_code}")
 
-def generate_demo_image(prompt):
+def generate_demo_image(prompt, output):
     """Generate demo image while setting up local pipeline"""
     try:
         from PIL import Image, ImageDraw, ImageFont
@@ -180,21 +183,20 @@ def generate_demo_image(prompt):
             
             y_offset += 80
         
-        # Convert to base64
-        buffered = io.BytesIO()
-        img.save(buffered, format="PNG", quality=95)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
-        
-        return f"data:image/png;base64,{img_base64}"
+        # Convert to base64 in the requested format
+        return encode_generated_image(img, output)
         
     except Exception as e:
         print(f"Demo generation error: {e}")
         # Return simple colored square as absolute fallback
-        return "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+        return "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==", None
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
-    """Generate image - unlimited commercial use"""
+    """
+    Generate image - unlimited commercial use
+    Optional body fields: output_format (jpeg, webp, png) and output_quality (1-100)
+    """
     try:
         data = request.json
         prompt = data.get('prompt', '') if data else ''
@@ -202,20 +204,31 @@ def generate_image():
         if not prompt:
             return jsonify({'error': 'Prompt required'}), 400
         
+        try:
+            output = output_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         print(f"Generating: {prompt}")
         
         # Generate with professional APIs
-        image_result = generate_with_professional_apis(prompt)
+        image_result, transfer = generate_with_professional_apis(prompt, output)
         
         return jsonify({
             'success': True,
-            'image': image_result
+            'image': image_result,
+            'transfer': transfer
         })
         
     except Exception as e:
         print(f"Generation error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/scheduler', methods=['GET'])
+def scheduler_stats():
+    """Per-key utilization and queue time of the provider key pools"""
+    return jsonify({'providers': scheduler_report(['stability', 'openai'])})
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
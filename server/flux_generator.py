@@ -7,25 +7,32 @@ Commercial ready for unlimited generation
 
 import requests
 import json
-import base64
 import io
 import os
 import time
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from api_scheduler import (
+    DEFAULT_RETRY_AFTER,
+    PROVIDER_LIMITS,
+    get_scheduler,
+    raise_for_rate_limit,
+    retry_after_seconds,
+    scheduler_report,
+)
+from image_transcode import fetch_image, ingest_image, output_options
 
 app = Flask(__name__)
 CORS(app)
 
-def generate_with_replicate_flux(prompt):
+# Formats each provider can return natively; others are transcoded on ingest
+REPLICATE_FORMATS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+TOGETHER_FORMATS = {'png': 'png', 'jpeg': 'jpeg', 'webp': 'jpeg'}
+FAL_FORMATS = {'png': 'png', 'jpeg': 'jpeg', 'webp': 'jpeg'}
+
+def generate_with_replicate_flux(prompt, replicate_token, output):
     """Generate with Flux.1-dev via Replicate - most powerful open source model"""
     
-    # Replicate API for Flux.1-dev (commercial license, no restrictions)
-    replicate_token = os.getenv('REPLICATE_API_TOKEN', '')
-    
-    if not replicate_token:
-        raise Exception("REPLICATE_API_TOKEN required for Flux.1-dev generation")
-    
     # Use Flux.1-dev model - most advanced open source model
     response = requests.post(
         "https://api.replicate.com/v1/predictions",
@@ -42,11 +49,12 @@ def generate_with_replicate_flux(prompt):
                 "num_outputs": 1,
                 "guidance_scale": 3.5,
                 "num_inference_steps": 28,
-                "output_format": "png",
-                "output_quality": 100
+                "output_format": REPLICATE_FORMATS[output['format']],
+                "output_quality": output['quality']
             }
         }
     )
+    raise_for_rate_limit(response)
     
     if response.status_code != 201:
         raise Exception(f"Replicate API error: {response.status_code}")
@@ -62,6 +70,13 @@ def generate_with_replicate_flux(prompt):
             headers={"Authorization": f"Token {replicate_token}"}
         )
         
+        # A throttled poll waits and polls the same prediction again; raising
+        # RateLimited here would requeue the job and pay for a second prediction
+        if status_response.status_code == 429:
+            retry_after = retry_after_seconds(status_response)
+            time.sleep(DEFAULT_RETRY_AFTER if retry_after is None else retry_after)
+            continue
+        
         if status_response.status_code != 200:
             continue
             
@@ -71,9 +86,8 @@ def generate_with_replicate_flux(prompt):
             image_url = result['output'][0] if result['output'] else None
             if image_url:
                 # Download image and convert to base64
-                img_response = requests.get(image_url)
-                img_base64 = base64.b64encode(img_response.content).decode()
-                return f"data:image/png;base64,{img_base64}"
+                image_bytes, fetch_ms = fetch_image(image_url)
+                return ingest_image(image_bytes, output, fetch_ms)
             else:
                 raise Exception("No output generated")
                 
@@ -84,14 +98,9 @@ def generate_with_replicate_flux(prompt):
     
     raise Exception("Generation timeout")
 
-def generate_with_together_flux(prompt):
+def generate_with_together_flux(prompt, together_token, output):
     """Generate with Flux.1-schnell via Together AI - fastest option"""
     
-    together_token = os.getenv('TOGETHER_API_TOKEN', '')
-    
-    if not together_token:
-        raise Exception("TOGETHER_API_TOKEN required for Together AI generation")
-    
     response = requests.post(
         "https://api.together.xyz/v1/images/generations",
         headers={
@@ -105,25 +114,22 @@ def generate_with_together_flux(prompt):
             "height": 1024,
             "steps": 4,  # Schnell only needs 4 steps
             "n": 1,
-            "response_format": "b64_json"
+            "response_format": "b64_json",
+            "output_format": TOGETHER_FORMATS[output['format']]
         }
     )
+    raise_for_rate_limit(response)
     
     if response.status_code == 200:
         data = response.json()
         image_data = data['data'][0]['b64_json']
-        return f"data:image/png;base64,{image_data}"
+        return ingest_image(image_data, output)
     else:
         raise Exception(f"Together AI error: {response.status_code}")
 
-def generate_with_fal_flux(prompt):
+def generate_with_fal_flux(prompt, fal_token, output):
     """Generate with Flux via FAL - another fast option"""
     
-    fal_token = os.getenv('FAL_KEY', '')
-    
-    if not fal_token:
-        raise Exception("FAL_KEY required for FAL generation")
-    
     response = requests.post(
         "https://fal.run/fal-ai/flux/dev",
         headers={
@@ -136,24 +142,37 @@ def generate_with_fal_flux(prompt):
             "num_inference_steps": 28,
             "guidance_scale": 3.5,
             "num_images": 1,
+            "output_format": FAL_FORMATS[output['format']],
             "enable_safety_checker": False  # Disable content filters
         }
     )
+    raise_for_rate_limit(response)
     
     if response.status_code == 200:
         data = response.json()
         image_url = data['images'][0]['url']
         
         # Download and convert to base64
-        img_response = requests.get(image_url)
-        img_base64 = base64.b64encode(img_response.content).decode()
-        return f"data:image/png;base64,{img_base64}"
+        image_bytes, fetch_ms = fetch_image(image_url)
+        return ingest_image(image_bytes, output, fetch_ms)
     else:
         raise Exception(f"FAL error: {response.status_code}")
 
+def generate_with_pool(provider, generator, prompt, output):
+    """Runs a provider call on the next free key of its pool, queueing when over quota"""
+    pool = get_scheduler(provider)
+    
+    if not pool.has_keys():
+        raise Exception(f"{PROVIDER_LIMITS[provider]['env']} required for {provider} generation")
+    
+    return pool.run(lambda key: generator(prompt, key, output))
+
 @app.route('/generate', methods=['POST'])
 def generate_image():
-    """Generate with most powerful available Flux model"""
+    """
+    Generate with most powerful available Flux model
+    Optional body fields: output_format (jpeg, webp, png) and output_quality (1-100)
+    """
     try:
         data = request.json
         prompt = data.get('prompt', '') if data else ''
@@ -161,37 +180,45 @@ def generate_image():
         if not prompt:
             return jsonify({'error': 'Prompt required'}), 400
         
+        try:
+            output = output_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         print(f"Generating with Flux: {prompt}")
         
         # Try Replicate Flux.1-dev first (highest quality)
         try:
-            image_result = generate_with_replicate_flux(prompt)
+            image_result, transfer = generate_with_pool('replicate', generate_with_replicate_flux, prompt, output)
             return jsonify({
                 'success': True,
                 'image': image_result,
-                'model': 'Flux.1-dev'
+                'model': 'Flux.1-dev',
+                'transfer': transfer
             })
         except Exception as e:
             print(f"Replicate Flux failed: {e}")
         
         # Try Together AI Flux.1-schnell (fastest)
         try:
-            image_result = generate_with_together_flux(prompt)
+            image_result, transfer = generate_with_pool('together', generate_with_together_flux, prompt, output)
             return jsonify({
                 'success': True,
                 'image': image_result,
-                'model': 'Flux.1-schnell'
+                'model': 'Flux.1-schnell',
+                'transfer': transfer
             })
         except Exception as e:
             print(f"Together AI failed: {e}")
         
         # Try FAL Flux as final option
         try:
-            image_result = generate_with_fal_flux(prompt)
+            image_result, transfer = generate_with_pool('fal', generate_with_fal_flux, prompt, output)
             return jsonify({
                 'success': True,
                 'image': image_result,
-                'model': 'Flux-FAL'
+                'model': 'Flux-FAL',
+                'transfer': transfer
             })
         except Exception as e:
             print(f"FAL failed: {e}")
@@ -202,17 +229,22 @@ def generate_image():
         print(f"Generation error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/scheduler', methods=['GET'])
+def scheduler_stats():
+    """Per-key utilization and queue time of the provider key pools"""
+    return jsonify({'providers': scheduler_report(['replicate', 'together', 'fal'])})
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     
     # Check available providers
     providers = []
-    if os.getenv('REPLICATE_API_TOKEN'):
+    if get_scheduler('replicate').has_keys():
         providers.append('Replicate Flux.1-dev')
-    if os.getenv('TOGETHER_API_TOKEN'):
+    if get_scheduler('together').has_keys():
         providers.append('Together AI Flux.1-schnell') 
-    if os.getenv('FAL_KEY'):
+    if get_scheduler('fal').has_keys():
         providers.append('FAL Flux')
     
     return jsonify({
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Compact image transfer for the generator servers
+Negotiates lossy output formats and transcodes provider images on ingest,
+since every image ends up re-encoded as an H.264 video frame anyway
+"""
+
+import base64
+import io
+import os
+import time
+
+# Output formats accepted on /generate and their data URI MIME types
+OUTPUT_FORMATS = {
+    'png': {'mime': 'image/png'},
+    'jpeg': {'mime': 'image/jpeg'},
+    'webp': {'mime': 'image/webp'},
+}
+
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+# Defaults when a request does not ask for a format, overridable per server
+DEFAULT_OUTPUT_FORMAT = os.environ.get('IMAGE_OUTPUT_FORMAT', 'jpeg')
+DEFAULT_OUTPUT_QUALITY = int(os.environ.get('IMAGE_OUTPUT_QUALITY', 90))
+
+def output_options(data):
+    """
+    Reads output_format / output_quality from a /generate request body.
+    'explicit' tells whether the caller chose the format or got the default.
+    """
+    data = data or {}
+    output_format = str(data.get('output_format') or DEFAULT_OUTPUT_FORMAT).lower()
+    output_format = FORMAT_ALIASES.get(output_format, output_format)
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output_format: {output_format}")
+
+    quality = int(data.get('output_quality') or DEFAULT_OUTPUT_QUALITY)
+    if not 1 <= quality <= 100:
+        raise ValueError("output_quality must be between 1 and 100")
+
+    return {'format': output_format, 'quality': quality, 'explicit': bool(data.get('output_format'))}
+
+def sniff_format(image_bytes):
+    """Detects png/jpeg/webp from magic bytes, None for anything else"""
+    if image_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if image_bytes.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def encode_pil_image(image, output):
+    """Encodes a PIL image in the requested format"""
+    output_format = output['format']
+    buffered = io.BytesIO()
+
+    if output_format == 'png':
+        # compress_level 1 trades a little size for much faster encoding
+        image.save(buffered, format="PNG", compress_level=1)
+    elif output_format == 'jpeg':
+        image.convert('RGB').save(buffered, format="JPEG", quality=output['quality'])
+    else:
+        # method 0 is the fastest WebP encoder setting
+        image.convert('RGB').save(buffered, format="WEBP", quality=output['quality'], method=0)
+
+    return buffered.getvalue()
+
+def to_data_uri(image_bytes, output_format):
+    return f"data:{OUTPUT_FORMATS[output_format]['mime']};base64,{base64.b64encode(image_bytes).decode()}"
+
+def ingest_image(image, output, fetch_ms=None):
+    """
+    Converts a provider image (raw bytes, base64 string or data URI) into a data URI
+    in the requested format. Images already in that format pass through untouched.
+    When the format is only the default, images that would not get smaller keep
+    their own format; an explicitly requested format is always honored.
+    Returns (data_uri, transfer stats with bytes and latency before/after).
+    """
+    started = time.perf_counter()
+
+    if isinstance(image, str):
+        image = base64.b64decode(image.split(',', 1)[1] if image.startswith('data:') else image)
+
+    source_format = sniff_format(image)
+    output_format = output['format']
+    if source_format == output_format:
+        encoded = image
+    else:
+        from PIL import Image
+
+        encoded = encode_pil_image(Image.open(io.BytesIO(image)), output)
+
+        # Flat graphics can grow when made lossy, keep the original then
+        if source_format and not output.get('explicit') and len(encoded) >= len(image):
+            encoded = image
+            output_format = source_format
+
+    transfer = {
+        'source_format': source_format,
+        'requested_format': output['format'],
+        'output_format': output_format,
+        'quality': output['quality'],
+        'bytes_before': len(image),
+        'bytes_after': len(encoded),
+        'transcode_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+    if fetch_ms is not None:
+        transfer['fetch_ms'] = round(fetch_ms, 1)
+
+    print(
+        f"Image ingest: {source_format} {len(image)} B -> {output_format} {len(encoded)} B "
+        f"in {transfer['transcode_ms']} ms"
+    )
+    return to_data_uri(encoded, output_format), transfer
+
+def encode_generated_image(image, output):
+    """Encodes a locally generated PIL image, returns (data_uri, transfer stats)"""
+    started = time.perf_counter()
+    encoded = encode_pil_image(image, output)
+
+    transfer = {
+        'source_format': None,
+        'requested_format': output['format'],
+        'output_format': output['format'],
+        'quality': output['quality'],
+        'bytes_before': None,
+        'bytes_after': len(encoded),
+        'transcode_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+    return to_data_uri(encoded, output['format']), transfer
+
+def fetch_image(url):
+    """Downloads a provider image, returns (bytes, elapsed ms)"""
+    import requests
+
+    started = time.perf_counter()
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    return response.content, (time.perf_counter() - started) * 1000
@@ -7,11 +7,15 @@ Uses specialized models for unrestricted generation
 import torch
 import requests
 import json
-import base64
-import io
+import gc
 import os
+import signal
+import struct
+import time
+from pathlib import Path
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from image_transcode import encode_generated_image, ingest_image, output_options
 
 app = Flask(__name__)
 CORS(app)
@@ -20,6 +24,96 @@ CORS(app)
 pipeline = None
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Load RealisticVision or similar unrestricted model
+MODEL_ID = "SG161222/RealVisXL_V4.0"  # Highly realistic, no content filters
+
+# Prefork serving: workers fork from a parent that holds the weights, sharing them copy-on-write
+WORKERS = int(os.environ.get('SDXL_WORKERS', 1))
+TORCH_THREADS = int(os.environ.get('SDXL_TORCH_THREADS', 0)) or max(1, (os.cpu_count() or 1) // WORKERS)
+MMAP_WEIGHTS = os.environ.get('SDXL_MMAP_WEIGHTS', '1') == '1'
+
+# Pid of the weight-holding parent once serve_prefork runs, None when serving single-process
+prefork_parent_pid = None
+
+# Pipeline components whose safetensors files are memory-mapped on CPU
+MMAP_COMPONENTS = ['unet', 'vae', 'text_encoder', 'text_encoder_2']
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool
+}
+
+def mmap_safetensors(path):
+    """
+    Maps a safetensors file and returns tensors viewing the mapped pages.
+    The pages live in the page cache, so every process mapping the file shares them.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    
+    data_start = 8 + header_size
+    storage = torch.UntypedStorage.from_file(str(path), shared=False, nbytes=os.path.getsize(path))
+    
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__' or info['dtype'] not in SAFETENSORS_DTYPES:
+            continue
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        begin = data_start + info['data_offsets'][0]
+        
+        if begin % itemsize:
+            # Misaligned tensors cannot be viewed in place, they get a private copy
+            with open(path, 'rb') as f:
+                f.seek(begin)
+                raw = bytearray(f.read(info['data_offsets'][1] - info['data_offsets'][0]))
+            tensors[name] = torch.frombuffer(raw, dtype=dtype).reshape(info['shape'])
+        else:
+            tensors[name] = torch.empty(0, dtype=dtype).set_(storage, begin // itemsize, info['shape'])
+    return tensors
+
+def component_weight_files(model_dir, component, variant):
+    """Safetensors files of one pipeline component for the requested variant"""
+    files = sorted(Path(model_dir, component).glob('*.safetensors'))
+    if variant:
+        return [f for f in files if f".{variant}." in f.name]
+    # Variant files are named like diffusion_pytorch_model.fp16.safetensors
+    return [f for f in files if f.name.count('.') == 1]
+
+def memory_map_weights(model_id, variant=None):
+    """
+    Swaps the pipeline's CPU weights for memory-mapped views of the safetensors files,
+    so forked workers and separate processes share one copy through the page cache.
+    """
+    from huggingface_hub import snapshot_download
+    
+    model_dir = snapshot_download(model_id, local_files_only=True)
+    mapped = 0
+    
+    for component in MMAP_COMPONENTS:
+        module = getattr(pipeline, component, None)
+        if module is None:
+            continue
+        
+        tensors = {}
+        for weight_file in component_weight_files(model_dir, component, variant):
+            tensors.update(mmap_safetensors(weight_file))
+        
+        # Only assign tensors that match the loaded parameters exactly
+        current = module.state_dict()
+        matching = {
+            name: tensor for name, tensor in tensors.items()
+            if name in current and current[name].shape == tensor.shape and current[name].dtype == tensor.dtype
+        }
+        module.load_state_dict(matching, strict=False, assign=True)
+        mapped += len(matching)
+        print(f"Memory-mapped {len(matching)}/{len(current)} tensors of {component}")
+    
+    gc.collect()
+    return mapped
+
 def initialize_local_pipeline():
     """Initialize local SDXL with LoRA support"""
     global pipeline
@@ -29,11 +123,8 @@ def initialize_local_pipeline():
         
         from diffusers import StableDiffusionXLPipeline, DPMSolverMultistepScheduler
         
-        # Load RealisticVision or similar unrestricted model
-        model_id = "SG161222/RealVisXL_V4.0"  # Highly realistic, no content filters
-        
         pipeline = StableDiffusionXLPipeline.from_pretrained(
-            model_id,
+            MODEL_ID,
             torch_dtype=torch.float16 if device == "cuda" else torch.float32,
             use_safetensors=True,
             variant="fp16" if device == "cuda" else None
@@ -48,6 +139,11 @@ def initialize_local_pipeline():
             pipeline.enable_model_cpu_offload()
             pipeline.enable_vae_slicing()
             pipeline.enable_vae_tiling()
+        elif MMAP_WEIGHTS:
+            try:
+                memory_map_weights(MODEL_ID)
+            except Exception as e:
+                print(f"Weight memory-mapping unavailable, keeping loaded copy: {e}")
         
         print("Local SDXL pipeline loaded successfully!")
         return True
@@ -56,7 +152,7 @@ def initialize_local_pipeline():
         print(f"Pipeline initialization error: {e}")
         return False
 
-def generate_with_a1111_api(prompt):
+def generate_with_a1111_api(prompt, output):
     """Generate using Automatic1111 WebUI API if available"""
     try:
         # Try to connect to local A1111 instance
@@ -84,14 +180,15 @@ def generate_with_a1111_api(prompt):
         if response.status_code == 200:
             data = response.json()
             if data.get('images'):
-                return f"data:image/png;base64,{data['images'][0]}"
+                # A1111 always returns PNG, transcode on ingest
+                return ingest_image(data['images'][0], output)
         
     except Exception as e:
         print(f"A1111 API not available: {e}")
     
-    return None
+    return None, None
 
-def generate_with_local_pipeline(prompt):
+def generate_with_local_pipeline(prompt, output):
     """Generate with local pipeline"""
     global pipeline
     
@@ -114,12 +211,8 @@ def generate_with_local_pipeline(prompt):
             num_images_per_prompt=1
         ).images[0]
         
-        # Convert to base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG", quality=95)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
-        
-        return f"data:image/png;base64,{img_base64}"
+        # Convert to base64 in the requested format
+        return encode_generated_image(image, output)
         
     except Exception as e:
         print(f"Local generation error: {e}")
@@ -127,7 +220,10 @@ def generate_with_local_pipeline(prompt):
 
 @app.route('/generate', methods=['POST'])
 def generate_image():
-    """Generate image with local models - no restrictions"""
+    """
+    Generate image with local models - no restrictions
+    Optional body fields: output_format (jpeg, webp, png) and output_quality (1-100)
+    """
     try:
         data = request.json
         prompt = data.get('prompt', '') if data else ''
@@ -135,25 +231,32 @@ def generate_image():
         if not prompt:
             return jsonify({'error': 'Prompt required'}), 400
         
+        try:
+            output = output_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         print(f"Generating locally: {prompt}")
         
         # Try A1111 WebUI first (if running)
-        image_result = generate_with_a1111_api(prompt)
+        image_result, transfer = generate_with_a1111_api(prompt, output)
         
         if image_result:
             return jsonify({
                 'success': True,
                 'image': image_result,
-                'model': 'Automatic1111 WebUI'
+                'model': 'Automatic1111 WebUI',
+                'transfer': transfer
             })
         
         # Fallback to local pipeline
-        image_result = generate_with_local_pipeline(prompt)
+        image_result, transfer = generate_with_local_pipeline(prompt, output)
         
         return jsonify({
             'success': True,
             'image': image_result,
-            'model': 'Local SDXL'
+            'model': 'Local SDXL',
+            'transfer': transfer
         })
         
     except Exception as e:
@@ -180,10 +283,164 @@ def health_check():
         'ready': True
     })
 
+def process_memory(pid):
+    """RSS, PSS and private memory of a process in MB, read from /proc"""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup", 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    
+    private_kb = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    return {
+        'pid': pid,
+        'rss_mb': round(fields.get('Rss', 0) / 1024, 1),
+        'pss_mb': round(fields.get('Pss', 0) / 1024, 1),
+        # Memory only this process holds, i.e. what each extra worker costs
+        'incremental_mb': round(private_kb / 1024, 1)
+    }
+
+def worker_pids(parent_pid):
+    """Live children of the prefork parent"""
+    try:
+        with open(f"/proc/{parent_pid}/task/{parent_pid}/children", 'r') as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        pids = []
+        for entry in Path('/proc').iterdir():
+            if entry.name.isdigit():
+                try:
+                    status = (entry / 'status').read_text()
+                except OSError:
+                    continue
+                if f"\nPPid:\t{parent_pid}\n" in status:
+                    pids.append(int(entry.name))
+        return pids
+
+def memory_report(parent_pid, prefork=True):
+    """Memory of the weight-holding parent and each worker; without prefork only the serving process"""
+    workers = []
+    for pid in worker_pids(parent_pid) if prefork else []:
+        try:
+            workers.append(process_memory(pid))
+        except OSError:
+            pass
+    
+    return {
+        'parent': process_memory(parent_pid),
+        'workers': workers,
+        'total_rss_mb': round(sum(w['rss_mb'] for w in workers), 1),
+        'total_pss_mb': round(sum(w['pss_mb'] for w in workers), 1),
+        'avg_incremental_mb': round(sum(w['incremental_mb'] for w in workers) / len(workers), 1) if workers else 0.0
+    }
+
+@app.route('/workers', methods=['GET'])
+def workers_report():
+    """Per-worker incremental RSS in prefork mode"""
+    if prefork_parent_pid is None:
+        return jsonify(memory_report(os.getpid(), prefork=False))
+    return jsonify(memory_report(prefork_parent_pid))
+
+def limit_torch_threads(threads):
+    """Caps intra-op threads so workers do not oversubscribe the CPU"""
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+def serve_prefork(host, port, workers):
+    """
+    Loads the pipeline once, then forks workers that serve requests on a shared socket.
+    Weights stay in pages shared copy-on-write (or mapped from the safetensors files);
+    dead workers are replaced until SIGTERM/SIGINT.
+    Returns False without forking when the parent cannot load the pipeline,
+    since every worker would then load its own copy on first request.
+    """
+    global prefork_parent_pid
+    from werkzeug.serving import make_server
+    
+    # No thread team in the parent, OpenMP pools do not survive fork
+    default_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    if not initialize_local_pipeline():
+        torch.set_num_threads(default_threads)
+        return False
+    
+    # Keep the cyclic GC from touching, and so copying, the parent's objects in workers
+    gc.collect()
+    gc.freeze()
+    
+    server = make_server(host, port, app, threaded=False)
+    prefork_parent_pid = os.getpid()
+    children = set()
+    stopping = False
+    
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            limit_torch_threads(TORCH_THREADS)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.add(pid)
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    for _ in range(workers):
+        spawn()
+    print(f"Serving on {host}:{port} with {workers} workers, {TORCH_THREADS} torch threads each")
+    
+    time.sleep(1)
+    report = memory_report(os.getpid())
+    print(
+        f"Parent RSS {report['parent']['rss_mb']} MB, "
+        f"avg incremental RSS per worker {report['avg_incremental_mb']} MB"
+    )
+    
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, restarting")
+            spawn()
+    
+    server.server_close()
+    return True
+
 if __name__ == '__main__':
     print("Starting Local SDXL Generator...")
     print("Unrestricted content generation ready")
     
     # Start server
     port = int(os.environ.get('PORT', 8002))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    
+    if WORKERS > 1 and device == "cuda":
+        # CUDA contexts cannot be shared across fork
+        print("Prefork mode is CPU only, serving with a single process on CUDA")
+        app.run(host='0.0.0.0', port=port, debug=False)
+    elif WORKERS > 1:
+        if not serve_prefork('0.0.0.0', port, WORKERS):
+            print("Pipeline failed to load in the prefork parent, serving with a single process")
+            app.run(host='0.0.0.0', port=port, debug=False)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
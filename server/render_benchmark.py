@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Render benchmark for video_processor
+Times the same job in each render mode and reports the speed ratio,
+and times a multi-rendition job against one run per rendition
+"""
+
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from video_processor import render_professional_video, rendition_settings, run_ffmpeg
+
+SAMPLE_SEGMENTS = [
+    "Quote one: The only true wisdom is in knowing you know nothing",
+    "Quote two: The unexamined life is not worth living",
+    "Quote three: Waste no more time arguing what a good man should be. Be one",
+    "Quote four: You have power over your mind, not outside events",
+]
+
+# Shorts, feed and a low-bitrate 720p copy
+SAMPLE_RENDITIONS = [
+    {'name': 'shorts', 'width': 1080, 'height': 1920},
+    {'name': 'feed', 'width': 1080, 'height': 1080},
+    {'name': 'low', 'width': 720, 'height': 1280, 'video_bitrate': 1500},
+]
+
+def make_sample_images(count, size=1024):
+    """Creates gradient frames in memory so the benchmark needs no generator"""
+    from PIL import Image
+
+    gradient = Image.linear_gradient('L').resize((size, size))
+    radial = Image.radial_gradient('L').resize((size, size))
+
+    images = []
+    for i in range(count):
+        tint = Image.new('L', (size, size), (60 * i) % 256)
+        images.append(Image.merge('RGB', (gradient, radial, tint)))
+    return images
+
+def probe_video(video_path):
+    """Decodes the video stream and returns (frame count, (width, height))"""
+    result = run_ffmpeg(['ffmpeg', '-i', str(video_path), '-map', '0:v:0', '-f', 'null', '-'])
+    frames = re.findall(r'frame=\s*(\d+)', result.stderr)
+    size = re.search(r'Video: .*?, (\d+)x(\d+)', result.stderr)
+    if result.returncode != 0 or not frames or not size:
+        raise Exception(f"Could not read benchmark output {video_path}: {result.stderr[-300:]}")
+    return int(frames[-1]), (int(size.group(1)), int(size.group(2)))
+
+def count_frames(video_path):
+    """Decodes the video stream and returns its frame count"""
+    return probe_video(video_path)[0]
+
+def time_render(config):
+    """
+    Renders once and returns elapsed seconds.
+    Fails if any output is missing clips or has the wrong size,
+    so a partial render is never timed as complete.
+    """
+    start = time.perf_counter()
+    render_professional_video(config)
+    elapsed = time.perf_counter() - start
+
+    for settings in rendition_settings(config):
+        output_path = settings['output_path']
+        if not os.path.exists(output_path):
+            raise Exception(f"{settings['mode']} render produced no output {output_path}")
+
+        clip_frames = round(settings['clip_duration'] * settings['fps'])
+        expected_frames = clip_frames * len(config['segments'])
+        frames, size = probe_video(output_path)
+
+        # Allow one frame of rounding per clip at the concat boundaries
+        if abs(frames - expected_frames) > len(config['segments']):
+            raise Exception(
+                f"{settings['mode']} render has {frames} frames, expected {expected_frames}: clips are missing"
+            )
+        if size != (settings['width'], settings['height']):
+            raise Exception(f"{output_path} is {size[0]}x{size[1]}, expected {settings['width']}x{settings['height']}")
+    return elapsed
+
+def run_benchmark(segment_count=4, segment_duration=6, draft_seconds=None):
+    """Renders the sample job in final and draft mode and returns the report"""
+    segments = (SAMPLE_SEGMENTS * segment_count)[:segment_count]
+    images = make_sample_images(segment_count)
+
+    report = {
+        'segments': segment_count,
+        'segment_duration': segment_duration,
+        'draft_seconds': draft_seconds,
+        'timings': {}
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for mode in ('final', 'draft'):
+            config = {
+                'segments': segments,
+                'images': images,
+                'output_path': str(Path(temp_dir) / f"benchmark_{mode}.mp4"),
+                'temp_dir': temp_dir,
+                'segment_duration': segment_duration,
+                'mode': mode,
+                'draft_seconds': draft_seconds
+            }
+            report['timings'][mode] = round(time_render(config), 3)
+            print(f"{mode} render: {report['timings'][mode]}s")
+
+    report['draft_speedup'] = round(report['timings']['final'] / report['timings']['draft'], 2)
+    print(f"Draft render is {report['draft_speedup']}x faster than final")
+    return report
+
+def run_rendition_benchmark(segment_count=4, segment_duration=6, mode='final', renditions=SAMPLE_RENDITIONS):
+    """
+    Renders all renditions in one job, then each rendition as its own job,
+    and returns the report with the single-pass speedup
+    """
+    segments = (SAMPLE_SEGMENTS * segment_count)[:segment_count]
+    images = make_sample_images(segment_count)
+
+    report = {
+        'segments': segment_count,
+        'segment_duration': segment_duration,
+        'mode': mode,
+        'renditions': [rendition['name'] for rendition in renditions],
+        'timings': {}
+    }
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        base_config = {
+            'segments': segments,
+            'images': images,
+            'temp_dir': temp_dir,
+            'segment_duration': segment_duration,
+            'mode': mode
+        }
+
+        report['timings']['single_pass'] = round(time_render(dict(
+            base_config,
+            output_path=str(Path(temp_dir) / "benchmark_single_pass.mp4"),
+            renditions=renditions
+        )), 3)
+        print(f"Single pass, {len(renditions)} renditions: {report['timings']['single_pass']}s")
+
+        separate = {}
+        for rendition in renditions:
+            # One rendition per run, the way a job per width/height used to be rendered
+            output_path = str(Path(temp_dir) / f"benchmark_separate_{rendition['name']}.mp4")
+            separate[rendition['name']] = round(time_render(dict(
+                base_config,
+                output_path=output_path,
+                renditions=[dict(rendition, output_path=output_path)]
+            )), 3)
+            print(f"Separate run {rendition['name']}: {separate[rendition['name']]}s")
+
+        report['timings']['separate'] = separate
+        report['timings']['separate_total'] = round(sum(separate.values()), 3)
+
+    report['single_pass_speedup'] = round(
+        report['timings']['separate_total'] / report['timings']['single_pass'], 2
+    )
+    print(f"Single pass is {report['single_pass_speedup']}x faster than {len(renditions)} separate runs")
+    return report
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'renditions':
+        segment_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+        mode = sys.argv[3] if len(sys.argv) > 3 else 'final'
+        report = run_rendition_benchmark(segment_count, mode=mode)
+        print(json.dumps(report, indent=2))
+        sys.exit(0)
+
+    segment_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    draft_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    report = run_benchmark(segment_count, draft_seconds=draft_seconds)
+    print(json.dumps(report, indent=2))
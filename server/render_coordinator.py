@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+Distributed segment rendering for video_processor
+Splits a job's segments into shards, renders them on several workers
+and stitches the shard files back together in segment order
+"""
+
+import base64
+import hmac
+import io
+import json
+import math
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from pathlib import Path
+
+from video_processor import (
+    assemble_video,
+    job_workspace,
+    render_settings,
+    render_shard,
+)
+
+# Config keys forwarded to workers so every shard renders with the job's settings
+SHARD_CONFIG_KEYS = [
+    'width', 'height', 'segment_duration', 'mode', 'draft_seconds',
+    'clip_retries', 'retry_backoff', 'use_ram_disk'
+]
+
+# Keys a remote worker accepts from a posted shard; storage options stay under the worker's control
+WORKER_SHARD_KEYS = ['width', 'height', 'segment_duration', 'mode', 'draft_seconds', 'clip_retries', 'retry_backoff']
+
+# Upper bounds on the retry policy a client may request from a remote worker
+MAX_WORKER_CLIP_RETRIES = 5
+MAX_WORKER_RETRY_BACKOFF = 10.0
+
+# Default shard timeout: fixed startup allowance plus wall time per second of rendered video
+SHARD_TIMEOUT_BASE = 60
+SHARD_TIMEOUT_PER_VIDEO_SECOND = 20
+
+# Seconds allowed to open a connection to a remote worker
+HTTP_CONNECT_TIMEOUT = 10
+
+# Shared secret between coordinator and HTTP workers, sent as a bearer token
+WORKER_TOKEN = os.environ.get('RENDER_WORKER_TOKEN', '')
+
+def image_to_data_uri(image):
+    """Converts any image accepted by video_processor into a JSON-safe data URI"""
+    if isinstance(image, (str, Path)):
+        image = str(image)
+        if image.startswith('data:'):
+            return image
+        with open(image, 'rb') as f:
+            image = f.read()
+
+    if not isinstance(image, (bytes, bytearray, memoryview)):
+        from PIL import Image
+
+        if not hasattr(image, 'convert'):
+            image = Image.fromarray(image)
+        buffered = io.BytesIO()
+        image.convert('RGB').save(buffered, format="PNG")
+        image = buffered.getvalue()
+
+    return f"data:image/png;base64,{base64.b64encode(bytes(image)).decode()}"
+
+def shard_timeout(shard, config):
+    """Seconds a shard may take before it is treated as lost"""
+    if config.get('shard_timeout'):
+        return config['shard_timeout']
+
+    clip_duration = render_settings(config)['clip_duration']
+    return SHARD_TIMEOUT_BASE + len(shard['segments']) * clip_duration * SHARD_TIMEOUT_PER_VIDEO_SECOND
+
+class LocalProcessWorker:
+    """Renders shards in a separate Python process on this host"""
+
+    def __init__(self):
+        self.name = 'local'
+
+    def render(self, shard, output_path, timeout, cancelled):
+        shard_file = Path(output_path).with_suffix('.json')
+        log_file = Path(output_path).with_suffix('.log')
+        with open(shard_file, 'w') as f:
+            json.dump(dict(shard, output_path=str(output_path)), f)
+
+        # Own session so a timeout can kill the worker together with its ffmpeg children
+        with open(log_file, 'w') as log:
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), 'worker', str(shard_file)],
+                stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+
+            deadline = time.monotonic() + timeout
+            while process.poll() is None:
+                if cancelled.is_set() or time.monotonic() > deadline:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+                    reason = 'cancelled' if cancelled.is_set() else f"timed out after {timeout}s"
+                    raise Exception(f"Local worker {reason}")
+                time.sleep(0.2)
+
+        if process.returncode != 0:
+            raise Exception(f"Local worker failed: {log_file.read_text()[-500:]}")
+
+class HttpWorker:
+    """Renders shards on a remote host running `render_coordinator.py serve`"""
+
+    def __init__(self, url):
+        self.name = url
+        self.url = url.rstrip('/')
+
+    def render(self, shard, output_path, timeout, cancelled):
+        import requests
+
+        headers = {'Authorization': f"Bearer {WORKER_TOKEN}"} if WORKER_TOKEN else {}
+        outcome = {}
+
+        def post():
+            try:
+                response = requests.post(
+                    f"{self.url}/render_shard",
+                    json=shard,
+                    headers=headers,
+                    stream=True,
+                    timeout=(HTTP_CONNECT_TIMEOUT, timeout)
+                )
+            except Exception as e:
+                outcome['error'] = e
+                return
+            # Nobody reads the response of an abandoned request, release its connection
+            if cancelled.is_set():
+                response.close()
+            outcome['response'] = response
+
+        # The POST blocks for the whole remote render, so it runs on its own thread
+        # and a cancelled job stops waiting instead of holding the pool until it returns.
+        # The remote worker finishes that render and its result is dropped.
+        request_thread = threading.Thread(target=post, daemon=True)
+        request_thread.start()
+        while request_thread.is_alive():
+            if cancelled.is_set():
+                raise Exception(f"Shard on {self.url} cancelled")
+            request_thread.join(0.2)
+
+        if 'error' in outcome:
+            raise outcome['error']
+
+        response = outcome['response']
+        try:
+            if response.status_code != 200:
+                raise Exception(f"Worker {self.url} error: {response.status_code}")
+
+            with open(output_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    if cancelled.is_set():
+                        raise Exception("Shard download cancelled")
+                    f.write(chunk)
+        finally:
+            response.close()
+
+def make_worker(spec):
+    """Builds a worker from a config entry: 'local' or an http(s) URL"""
+    if spec == 'local':
+        return LocalProcessWorker()
+    if spec.startswith('http://') or spec.startswith('https://'):
+        return HttpWorker(spec)
+    raise Exception(f"Unknown render worker: {spec}")
+
+def split_shards(config, shard_count):
+    """Splits the job into contiguous shards of segments"""
+    segments = config['segments']
+    images = config['images']
+
+    if not segments:
+        raise Exception("No clips were created successfully")
+
+    shard_size = config.get('shard_size')
+    if shard_size is None:
+        shard_size = math.ceil(len(segments) / shard_count)
+    if not isinstance(shard_size, int) or isinstance(shard_size, bool) or shard_size <= 0:
+        raise Exception(f"shard_size must be a positive integer, got {shard_size!r}")
+
+    shards = []
+    for start in range(0, len(segments), shard_size):
+        shard = {key: config[key] for key in SHARD_CONFIG_KEYS if key in config}
+        shard.update({
+            'job_id': f"{config.get('job_id', 'job')}_shard{len(shards)}",
+            'start_index': start,
+            'segments': segments[start:start + shard_size],
+            'images': [image_to_data_uri(image) for image in images[start:start + shard_size]]
+        })
+        shards.append(shard)
+    return shards
+
+def remove_partial_output(output_path):
+    """Deletes a partially written shard file so a retry starts clean"""
+    try:
+        os.remove(output_path)
+    except FileNotFoundError:
+        pass
+
+def render_shard_with_retries(shard_index, shard, workers, output_path, retries, timeout, cancelled):
+    """Renders one shard, moving to the next worker after each failed or lost attempt"""
+    last_error = None
+    for attempt in range(retries + 1):
+        if cancelled.is_set():
+            raise Exception(f"Shard {shard_index} cancelled")
+
+        worker = workers[(shard_index + attempt) % len(workers)]
+        remove_partial_output(output_path)
+        try:
+            worker.render(shard, output_path, timeout, cancelled)
+            print(f"Shard {shard_index} rendered by {worker.name}")
+            return str(output_path)
+        except Exception as e:
+            last_error = e
+            remove_partial_output(output_path)
+            print(f"Shard {shard_index} attempt {attempt + 1} on {worker.name} failed: {e}")
+
+    raise Exception(f"Shard {shard_index} failed after {retries + 1} attempts: {last_error}")
+
+def render_distributed(config):
+    """
+    Renders a job across several workers and stitches the shards in order.
+    Config is a video_processor config plus:
+    workers (list of 'local' or worker URLs), shard_size, shard_retries,
+    shard_timeout (seconds, derived from the shard's video length by default)
+    """
+    if config.get('renditions'):
+        raise Exception("Shards render a single rendition, render multi-rendition jobs with video_processor")
+
+    settings = render_settings(config)
+    workers = [make_worker(spec) for spec in config.get('workers', ['local'])]
+    retries = config.get('shard_retries', 2)
+    shards = split_shards(config, len(workers))
+
+    print(f"Rendering {len(config['segments'])} segments as {len(shards)} shards on {len(workers)} workers...")
+
+    with job_workspace(config) as temp_dir:
+        cancelled = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=len(workers))
+        try:
+            futures = [
+                pool.submit(
+                    render_shard_with_retries,
+                    i, shard, workers, temp_dir / f"shard_{i}.mp4",
+                    retries, shard_timeout(shard, config), cancelled
+                )
+                for i, shard in enumerate(shards)
+            ]
+
+            # Fail fast: the first shard that runs out of retries stops the others
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            failed = [future for future in done if future.exception()]
+            if failed:
+                cancelled.set()
+                raise failed[0].exception()
+
+            shard_files = [future.result() for future in futures]
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        assemble_video(
+            shard_files, temp_dir / "concat_list.txt",
+            config.get('audio_file'), config['output_path'], settings
+        )
+
+    print(f"Distributed video created successfully: {config['output_path']}")
+    return True
+
+def validate_worker_shard(shard):
+    """
+    Checks a posted shard and returns a copy holding only the render options.
+    Images must be data URIs so clients cannot point ffmpeg at files on the worker.
+    """
+    if not isinstance(shard, dict):
+        raise ValueError('Shard must be a JSON object')
+
+    segments = shard.get('segments')
+    images = shard.get('images')
+    if not isinstance(segments, list) or not segments or not all(isinstance(s, str) for s in segments):
+        raise ValueError('Shard segments required')
+    if not isinstance(images, list) or len(images) != len(segments):
+        raise ValueError('One image per segment required')
+    if not all(isinstance(image, str) and image.startswith('data:image/') for image in images):
+        raise ValueError('Images must be data URIs')
+
+    start_index = shard.get('start_index', 0)
+    if not isinstance(start_index, int) or isinstance(start_index, bool) or start_index < 0:
+        raise ValueError('start_index must be a non-negative integer')
+
+    clean_shard = {key: shard[key] for key in WORKER_SHARD_KEYS if key in shard}
+    if 'clip_retries' in clean_shard:
+        clean_shard['clip_retries'] = min(max(int(clean_shard['clip_retries']), 0), MAX_WORKER_CLIP_RETRIES)
+    if 'retry_backoff' in clean_shard:
+        clean_shard['retry_backoff'] = min(max(float(clean_shard['retry_backoff']), 0.0), MAX_WORKER_RETRY_BACKOFF)
+    clean_shard.update({
+        'job_id': uuid.uuid4().hex[:12],
+        'start_index': start_index,
+        'segments': segments,
+        'images': images,
+        'use_ram_disk': os.environ.get('RENDER_USE_RAM_DISK', '') == '1'
+    })
+    return clean_shard
+
+def create_worker_app():
+    """Flask app that renders shards posted by a coordinator"""
+    import tempfile
+    from flask import Flask, request, jsonify, send_file
+
+    app = Flask(__name__)
+
+    @app.route('/render_shard', methods=['POST'])
+    def render_shard_endpoint():
+        """Render one shard and return the stitched clip file"""
+        if WORKER_TOKEN:
+            auth = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(auth, f"Bearer {WORKER_TOKEN}"):
+                return jsonify({'error': 'Unauthorized'}), 401
+
+        try:
+            shard = validate_worker_shard(request.get_json(silent=True))
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+
+        try:
+            output_dir = tempfile.mkdtemp(prefix='shard_')
+            try:
+                shard['output_path'] = os.path.join(output_dir, 'shard.mp4')
+                shard['temp_dir'] = os.environ.get('RENDER_TEMP_DIR', output_dir)
+                render_shard(shard)
+
+                with open(shard['output_path'], 'rb') as f:
+                    data = io.BytesIO(f.read())
+            finally:
+                shutil.rmtree(output_dir, ignore_errors=True)
+
+            return send_file(data, mimetype='video/mp4')
+
+        except Exception as e:
+            print(f"Shard render error: {str(e)}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/health', methods=['GET'])
+    def health_check():
+        """Health check endpoint"""
+        return jsonify({'status': 'healthy', 'ready': True})
+
+    return app
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python render_coordinator.py <config_file>")
+        print("       python render_coordinator.py worker <shard_file>")
+        print("       python render_coordinator.py serve")
+        sys.exit(1)
+
+    if sys.argv[1] == 'serve':
+        if not WORKER_TOKEN:
+            print("Warning: RENDER_WORKER_TOKEN is not set, /render_shard accepts unauthenticated requests")
+        port = int(os.environ.get('PORT', 8003))
+        create_worker_app().run(host='0.0.0.0', port=port, debug=False, threaded=True)
+        sys.exit(0)
+
+    try:
+        if sys.argv[1] == 'worker':
+            with open(sys.argv[2], 'r') as f:
+                shard_config = json.load(f)
+            shard_config.setdefault('temp_dir', str(Path(shard_config['output_path']).parent))
+            render_shard(shard_config)
+        else:
+            with open(sys.argv[1], 'r') as f:
+                render_distributed(json.load(f))
+    except Exception as e:
+        print(f"Error in distributed rendering: {str(e)}")
+        sys.exit(1)
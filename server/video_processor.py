@@ -6,140 +6,682 @@ Handles complex video editing, transitions, and effects
 
 import subprocess
 import json
+import base64
+import hashlib
 import os
 import sys
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
 import tempfile
 
-def create_professional_video(config_file_path):
+# tmpfs mount used when 'use_ram_disk' is set in the config
+RAM_DISK_PATH = '/dev/shm'
+
+# Encoder settings per render mode. 'scale' shrinks the frame and layout together
+# so a draft keeps the exact text placement of the final render.
+RENDER_PROFILES = {
+    'final': {'scale': 1.0, 'fps': 30, 'preset': 'medium', 'crf': 18},
+    'draft': {'scale': 0.5, 'fps': 15, 'preset': 'ultrafast', 'crf': 30},
+}
+
+# Rough upper bound of intermediate bytes written per segment (1080x1920 clip at crf 18)
+BYTES_PER_SEGMENT_ESTIMATE = 40 * 1024 * 1024
+
+def has_free_space(directory, required_bytes):
+    """Check that a directory's filesystem can hold the job's intermediates"""
+    try:
+        return shutil.disk_usage(directory).free >= required_bytes
+    except OSError:
+        return False
+
+def resolve_temp_root(config, required_bytes):
     """
-    Creates a professional video with advanced FFmpeg features
-    Config should contain: segments, images, audio, output_path, dimensions
+    Pick the directory that will hold intermediates.
+    Prefers tmpfs when 'use_ram_disk' is set and it has room, otherwise 'temp_dir'.
     """
+    if config.get('use_ram_disk') and os.path.isdir(RAM_DISK_PATH) and os.access(RAM_DISK_PATH, os.W_OK):
+        if has_free_space(RAM_DISK_PATH, required_bytes):
+            return Path(RAM_DISK_PATH)
+        print(f"Not enough space on {RAM_DISK_PATH}, falling back to disk")
+    
+    temp_root = Path(config.get('temp_dir') or tempfile.gettempdir())
+    temp_root.mkdir(parents=True, exist_ok=True)
+    
+    if not has_free_space(temp_root, required_bytes):
+        raise Exception(f"Not enough free space in {temp_root}: need {required_bytes // (1024 * 1024)} MB")
+    
+    return temp_root
+
+def resumable_job_id(config):
+    """Stable job id for resumable jobs, derived from the output path unless 'job_id' is set"""
+    if config.get('job_id'):
+        return config['job_id']
+    return hashlib.sha256(os.path.abspath(config['output_path']).encode()).hexdigest()[:12]
+
+@contextmanager
+def job_workspace(config):
+    """
+    Creates a unique working directory for one render job and always removes it.
+    Set 'keep_on_failure' in the config to keep intermediates of failed runs for debugging.
+    With 'resume' the directory is named after the job and kept on failure,
+    so a re-run picks up the clips that were already encoded.
+    """
+    required_bytes = config.get('min_free_bytes', BYTES_PER_SEGMENT_ESTIMATE * len(config['segments']))
+    
+    if config.get('resume'):
+        job_id = resumable_job_id(config)
+        candidates = [Path(RAM_DISK_PATH), Path(config.get('temp_dir') or tempfile.gettempdir())]
+        existing = [root / f"job_{job_id}" for root in candidates if (root / f"job_{job_id}").is_dir()]
+        workspace = existing[0] if existing else resolve_temp_root(config, required_bytes) / f"job_{job_id}"
+        workspace.mkdir(exist_ok=True)
+        keep_on_failure = True
+    else:
+        temp_root = resolve_temp_root(config, required_bytes)
+        job_id = config.get('job_id') or uuid.uuid4().hex[:12]
+        workspace = Path(tempfile.mkdtemp(prefix=f"job_{job_id}_", dir=temp_root))
+        keep_on_failure = config.get('keep_on_failure', False)
+    
+    succeeded = False
     try:
-        # Load configuration
-        with open(config_file_path, 'r') as f:
-            config = json.load(f)
+        yield workspace
+        succeeded = True
+    finally:
+        if succeeded or not keep_on_failure:
+            shutil.rmtree(workspace, ignore_errors=True)
+        else:
+            print(f"Keeping workspace of failed job: {workspace}")
+
+def file_sha256(path):
+    """Hashes a file in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_digest(image):
+    """Content hash of any image accepted by image_input"""
+    if isinstance(image, (str, Path)):
+        image = str(image)
+        if image.startswith('data:'):
+            return hashlib.sha256(image.encode()).hexdigest()
+        return file_sha256(image) if os.path.exists(image) else f"missing:{image}"
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha256(bytes(image)).hexdigest()
+    if hasattr(image, 'convert'):
+        return hashlib.sha256(repr(image.size).encode() + image.convert('RGB').tobytes()).hexdigest()
+    if hasattr(image, 'tobytes'):
+        return hashlib.sha256(repr(image.shape).encode() + image.tobytes(order='C')).hexdigest()
+    return f"unhashable:{type(image).__name__}"
+
+class JobManifest:
+    """
+    Records the state, attempts and output hash of every clip and of the final
+    assembly. Saved as JSON after each change when a path is given, so a failed
+    job can be inspected and resumed.
+    """
+    
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.data = {'clips': {}, 'assembly': {'state': 'pending'}}
         
-        segments = config['segments']
-        images = config['images']
-        audio_file = config.get('audio_file')
-        output_path = config['output_path']
-        width = config.get('width', 1080)
-        height = config.get('height', 1920)
-        segment_duration = config.get('segment_duration', 6)
+        if self.path and self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest {self.path}: {e}")
+    
+    def save(self):
+        if not self.path:
+            return
+        self.data['updated_at'] = time.time()
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(temp_path, self.path)
+    
+    def clip(self, index):
+        return self.data['clips'].get(str(index), {})
+    
+    def completed_clip(self, index, input_hash, clip_files):
+        """True when the clip was encoded from the same inputs and all its renditions are intact on disk"""
+        entry = self.clip(index)
+        return (
+            entry.get('state') == 'done'
+            and entry.get('input_hash') == input_hash
+            and all(os.path.exists(clip_file) for clip_file in clip_files)
+            and combined_hash([file_sha256(clip_file) for clip_file in clip_files]) == entry.get('output_hash')
+        )
+    
+    def record_clip(self, index, **fields):
+        self.data['clips'][str(index)] = dict(self.clip(index), **fields)
+        self.save()
+    
+    def record_assembly(self, **fields):
+        self.data['assembly'] = dict(self.data['assembly'], **fields)
+        self.save()
+
+def run_ffmpeg(cmd, stdin_data=None):
+    """Runs ffmpeg, feeding stdin_data to a pipe input when given"""
+    result = subprocess.run(cmd, input=stdin_data, capture_output=True)
+    result.stderr = result.stderr.decode(errors='replace')
+    return result
+
+def even(value):
+    """Rounds a dimension down to an even number as required by yuv420p"""
+    return max(2, int(value) // 2 * 2)
+
+def render_settings(config):
+    """
+    Resolves output size, encoder settings, clip length and retry policy for the config.
+    'mode' is 'final' (default) or 'draft'; 'draft_seconds' trims each draft clip.
+    'clip_retries' and 'retry_backoff' control per-clip retries; 'strict' (default)
+    fails the job when a clip is still missing after its retries.
+    """
+    mode = config.get('mode', 'final')
+    if mode not in RENDER_PROFILES:
+        raise Exception(f"Unknown render mode: {mode}")
+    
+    profile = RENDER_PROFILES[mode]
+    scale = profile['scale']
+    clip_duration = config.get('segment_duration', 6)
+    
+    if mode == 'draft' and config.get('draft_seconds'):
+        clip_duration = min(clip_duration, config['draft_seconds'])
+    
+    return {
+        'mode': mode,
+        'width': even(config.get('width', 1080) * scale),
+        'height': even(config.get('height', 1920) * scale),
+        'scale': scale,
+        'fps': profile['fps'],
+        'preset': profile['preset'],
+        'crf': profile['crf'],
+        'clip_duration': clip_duration,
+        'clip_retries': int(config.get('clip_retries', 2)),
+        'retry_backoff': float(config.get('retry_backoff', 1.0)),
+        'strict': config.get('strict', True)
+    }
+
+def rendition_settings(config):
+    """
+    Resolves one settings dict per output rendition.
+    'renditions' is a list of {'width', 'height'} with optional 'name', 'output_path'
+    (defaults to <output>_<name>), 'crf', 'video_bitrate' (kbit/s) and 'audio_bitrate'.
+    Text sizes and offsets follow each rendition's short side relative to the job's
+    width/height, so a 720p copy of a 1080p layout looks the same, only smaller.
+    Without 'renditions' the job has a single rendition at output_path.
+    """
+    base = render_settings(config)
+    renditions = config.get('renditions')
+    if not renditions:
+        return [dict(base, name=None, output_path=config['output_path'], video_bitrate=None, audio_bitrate='128k')]
+    
+    profile_scale = RENDER_PROFILES[base['mode']]['scale']
+    base_short_side = min(config.get('width', 1080), config.get('height', 1920))
+    output = Path(config['output_path'])
+    
+    settings = []
+    for rendition in renditions:
+        width = rendition.get('width', config.get('width', 1080))
+        height = rendition.get('height', config.get('height', 1920))
+        name = str(rendition.get('name') or f"{width}x{height}")
+        if not name.replace('-', '').replace('_', '').isalnum():
+            raise Exception(f"Rendition name may only hold letters, digits, '-' and '_': {name}")
+    
+        settings.append(dict(
+            base,
+            name=name,
+            output_path=rendition.get('output_path') or str(output.with_name(f"{output.stem}_{name}{output.suffix or '.mp4'}")),
+            width=even(width * profile_scale),
+            height=even(height * profile_scale),
+            scale=profile_scale * min(width, height) / base_short_side,
+            crf=rendition.get('crf', base['crf']),
+            video_bitrate=rendition.get('video_bitrate'),
+            audio_bitrate=rendition.get('audio_bitrate', '128k')
+        ))
+    
+    for key in ('name', 'output_path'):
+        values = [rendition[key] for rendition in settings]
+        if len(set(values)) != len(values):
+            raise Exception(f"Rendition {key}s must be unique: {values}")
+    
+    return settings
+
+def format_segment_text(segment):
+    """Extracts the quote text displayed on a clip"""
+    display_text = segment.replace('"', '').replace("'", "'")
+    
+    # Clean text for quotes - extract quote part if format is "Quote one: text"
+    if ':' in display_text:
+        parts = display_text.split(':', 1)
+        if len(parts) > 1:
+            display_text = parts[1].strip()
+    
+    # Limit text length for readability
+    if len(display_text) > 120:
+        display_text = display_text[:120] + '...'
+    
+    return display_text
+
+def build_clip_filter(number_text, display_text, width, height, scale=1.0):
+    """
+    Builds the scale/crop and animated text overlay filter for one clip.
+    Font sizes, borders and offsets are multiplied by scale so that smaller
+    renders keep the same layout as the full-size one.
+    """
+    def px(value):
+        return max(1, round(value * scale))
+    
+    return (
+        f"scale={width*1.1}:{height*1.1}:force_original_aspect_ratio=increase,"
+        f"crop={width}:{height}:(iw-ow)/2:(ih-oh)/2,"
+        f"drawtext=text='{number_text}':fontsize={px(140)}:fontcolor=white:borderw={px(8)}:bordercolor=black@0.9:"
+        f"x=(w-text_w)/2:y=h*0.12:enable='gte(t,0.3)':alpha='min(1\\,max(0\\,(t-0.3)*4))':"
+        f"fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf,"
+        f"drawtext=text='{display_text}':fontsize={px(68)}:fontcolor=white:borderw={px(5)}:bordercolor=black@0.85:"
+        f"x=(w-text_w)/2:y=(h-text_h)/2+{px(20)}:enable='gte(t,0.8)':alpha='min(1\\,max(0\\,(t-0.8)*3))':"
+        f"fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf,"
+        f"drawtext=text='{display_text}':fontsize={px(68)}:fontcolor=black@0.4:"
+        f"x=(w-text_w)/2+{px(4)}:y=(h-text_h)/2+{px(24)}:enable='gte(t,0.85)':alpha='min(0.7\\,max(0\\,(t-0.85)*4))':"
+        f"fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+    )
+
+def image_input(image):
+    """
+    Returns (ffmpeg input args, stdin bytes, loop filter) for one image.
+    Accepts a file path, a base64 data URI, encoded image bytes,
+    or a decoded RGB frame (PIL image or HxWx3 uint8 array).
+    In-memory images are streamed over stdin instead of being written to disk.
+    """
+    if isinstance(image, (str, Path)):
+        image = str(image)
+        if not image.startswith('data:'):
+            return ['-loop', '1', '-i', image], None, ''
+        # Data URI as returned by the image generators
+        image = base64.b64decode(image.split(',', 1)[1])
+    
+    # A piped input holds a single frame, so it is repeated with the loop filter
+    loop_filter = 'loop=loop=-1:size=1:start=0,'
+    
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return ['-f', 'image2pipe', '-i', 'pipe:0'], bytes(image), loop_filter
+    
+    if hasattr(image, 'size') and hasattr(image, 'convert'):
+        # PIL image
+        frame_width, frame_height = image.size
+        frame = image.convert('RGB').tobytes()
+    elif (hasattr(image, 'shape') and len(image.shape) == 3 and image.shape[2] == 3
+          and str(getattr(image, 'dtype', '')) == 'uint8'):
+        # numpy RGB array, rawvideo rgb24 expects one byte per channel
+        frame_height, frame_width = image.shape[:2]
+        frame = image.tobytes(order='C')
+    else:
+        dtype = getattr(image, 'dtype', None)
+        detail = f" ({dtype})" if dtype is not None else ""
+        raise Exception(f"Unsupported image type: {type(image).__name__}{detail}")
+    
+    raw_args = [
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgb24',
+        '-s', f"{frame_width}x{frame_height}",
+        '-i', 'pipe:0'
+    ]
+    return raw_args, frame, loop_filter
+
+def render_clip(image, segment, index, clip_file, settings):
+    """Encodes one segment clip, returns the ffmpeg result"""
+    display_text = format_segment_text(segment)
+    number_text = str(index + 1)
+    input_args, stdin_data, loop_filter = image_input(image)
+    
+    # Professional FFmpeg command with advanced effects
+    ffmpeg_cmd = ['ffmpeg', '-y'] + input_args + [
+        '-t', str(settings['clip_duration']),
+        '-vf', loop_filter + build_clip_filter(
+            number_text, display_text, settings['width'], settings['height'], settings['scale']
+        ),
+        '-c:v', 'libx264',
+        '-preset', settings['preset'],
+        '-crf', str(settings['crf']),
+        '-pix_fmt', 'yuv420p',
+        '-r', str(settings['fps']),
+        str(clip_file)
+    ]
+    
+    return run_ffmpeg(ffmpeg_cmd, stdin_data)
+
+def render_rendition_clips(image, segment, index, clip_files, renditions):
+    """
+    Encodes one segment clip per rendition from a single decode of the image:
+    the frame is split in one filtergraph and each branch gets its own layout.
+    Returns the ffmpeg result.
+    """
+    if len(renditions) == 1:
+        return render_clip(image, segment, index, clip_files[0], renditions[0])
+    
+    display_text = format_segment_text(segment)
+    number_text = str(index + 1)
+    input_args, stdin_data, loop_filter = image_input(image)
+    
+    branches = ''.join(f"[src{k}]" for k in range(len(renditions)))
+    graph = [f"[0:v]{loop_filter}split={len(renditions)}{branches}"]
+    for k, settings in enumerate(renditions):
+        graph.append(f"[src{k}]" + build_clip_filter(
+            number_text, display_text, settings['width'], settings['height'], settings['scale']
+        ) + f"[out{k}]")
+    
+    ffmpeg_cmd = ['ffmpeg', '-y'] + input_args + ['-filter_complex', ';'.join(graph)]
+    for k, (settings, clip_file) in enumerate(zip(renditions, clip_files)):
+        ffmpeg_cmd.extend([
+            '-map', f"[out{k}]",
+            '-t', str(settings['clip_duration']),
+            '-c:v', 'libx264',
+            '-preset', settings['preset'],
+            '-crf', str(settings['crf']),
+            '-pix_fmt', 'yuv420p',
+            '-r', str(settings['fps']),
+            str(clip_file)
+        ])
+    
+    return run_ffmpeg(ffmpeg_cmd, stdin_data)
+
+def combined_hash(hashes):
+    """A single hash stays as is, several are folded into one so manifests keep one field"""
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.sha256(','.join(hashes).encode()).hexdigest()
+
+def clip_input_hash(image, segment, index, settings):
+    """Hash of everything that determines a clip's pixels, used to validate resumed clips"""
+    layout = {key: settings[key] for key in ('width', 'height', 'scale', 'fps', 'preset', 'crf', 'clip_duration')}
+    payload = json.dumps([index, segment, image_digest(image), layout], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def renditions_input_hash(image, segment, index, renditions):
+    return combined_hash([clip_input_hash(image, segment, index, settings) for settings in renditions])
+
+def render_clip_with_retries(image, segment, index, clip_files, renditions):
+    """
+    Renders a clip in every rendition, retrying failures with exponential backoff.
+    Returns (success, attempts, last error).
+    """
+    settings = renditions[0]
+    error = None
+    attempts = settings['clip_retries'] + 1
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(settings['retry_backoff'] * 2 ** (attempt - 1))
+        try:
+            result = render_rendition_clips(image, segment, index, clip_files, renditions)
+            if result.returncode == 0:
+                return True, attempt + 1, None
+            error = ' | '.join(result.stderr.strip().splitlines()[-3:])
+        except Exception as e:
+            error = str(e)
+        print(f"Error creating clip {index} (attempt {attempt + 1}/{attempts}): {error}")
+    
+    return False, attempts, error
+
+def write_concat_list(clip_files, concat_file):
+    """Writes the ffmpeg concat demuxer list for the given clips"""
+    with open(concat_file, 'w') as f:
+        for clip_file in clip_files:
+            f.write(f"file '{clip_file}'\n")
+
+def output_encoder_args(settings):
+    """Final video and audio encoding for one rendition, capped when it sets a 'video_bitrate'"""
+    args = [
+        '-c:v', 'libx264',
+        '-preset', settings['preset'],
+        '-crf', str(settings['crf'])
+    ]
+    if settings.get('video_bitrate'):
+        # Capped CRF: quality-driven, but never above the rendition's bitrate (kbit/s)
+        bitrate = int(settings['video_bitrate'])
+        args.extend(['-maxrate', f"{bitrate}k", '-bufsize', f"{bitrate * 2}k"])
+    return args + [
+        '-pix_fmt', 'yuv420p',
+        '-movflags', '+faststart',  # Optimize for web streaming
+        '-r', str(settings['fps'])
+    ]
+
+def assemble_video(clip_files, concat_file, audio_file, output_path, settings):
+    """Concatenates the clips and muxes the optional audio track"""
+    # Create concat file for smooth merging
+    write_concat_list(clip_files, concat_file)
+    
+    # Final assembly with professional encoding
+    final_cmd = [
+        'ffmpeg', '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', str(concat_file)
+    ]
+    
+    # Add audio if provided
+    if audio_file and os.path.exists(audio_file):
+        final_cmd.extend(['-i', audio_file])
+        final_cmd.extend(['-c:a', 'aac', '-b:a', settings.get('audio_bitrate', '128k'), '-shortest'])
+    
+    # Professional video encoding settings
+    final_cmd.extend(output_encoder_args(settings) + [str(output_path)])
+    
+    print("Assembling final professional video...")
+    result = run_ffmpeg(final_cmd)
+    
+    if result.returncode != 0:
+        raise Exception(f"Final assembly failed: {result.stderr}")
+
+def assemble_renditions(clip_lists, temp_dir, audio_file, output_paths, renditions):
+    """
+    Assembles every rendition in one ffmpeg run: each rendition's clips are a
+    concat input, the audio track is decoded once and muxed into every output.
+    """
+    if len(renditions) == 1:
+        return assemble_video(clip_lists[0], temp_dir / "concat_list.txt", audio_file, output_paths[0], renditions[0])
+    
+    final_cmd = ['ffmpeg', '-y']
+    for settings, clip_files in zip(renditions, clip_lists):
+        concat_file = temp_dir / f"concat_list_{settings['name']}.txt"
+        write_concat_list(clip_files, concat_file)
+        final_cmd.extend(['-f', 'concat', '-safe', '0', '-i', str(concat_file)])
+    
+    has_audio = bool(audio_file and os.path.exists(audio_file))
+    if has_audio:
+        final_cmd.extend(['-i', audio_file])
+    
+    for k, (settings, output_path) in enumerate(zip(renditions, output_paths)):
+        final_cmd.extend(['-map', f"{k}:v"])
+        if has_audio:
+            final_cmd.extend([
+                '-map', f"{len(renditions)}:a",
+                '-c:a', 'aac', '-b:a', settings['audio_bitrate'], '-shortest'
+            ])
+        final_cmd.extend(output_encoder_args(settings) + [str(output_path)])
+    
+    print(f"Assembling {len(renditions)} renditions...")
+    result = run_ffmpeg(final_cmd)
+    
+    if result.returncode != 0:
+        raise Exception(f"Final assembly failed: {result.stderr}")
+
+def render_segment_renditions(segments, images, renditions, temp_dir, start_index=0, manifest=None):
+    """
+    Encodes one clip per segment and rendition into temp_dir and returns the
+    created clip paths as one list per rendition.
+    start_index is the position of the first segment in the whole job,
+    so shards rendered elsewhere keep the job's clip numbering.
+    Clips the manifest already holds with matching inputs and hash are reused.
+    In strict mode a clip that still fails after its retries fails the job.
+    """
+    manifest = manifest or JobManifest()
+    strict = renditions[0]['strict']
+    
+    if len(images) < len(segments):
+        message = f"{len(segments) - len(images)} segments have no image"
+        if strict:
+            raise Exception(message)
+        print(f"Warning: {message}, they will be skipped")
+    
+    clip_lists = [[] for _ in renditions]
+    for offset, (segment, image) in enumerate(zip(segments, images)):
+        i = start_index + offset
+        clip_files = [
+            temp_dir / (f"professional_clip_{i}_{settings['name']}.mp4" if settings.get('name') else f"professional_clip_{i}.mp4")
+            for settings in renditions
+        ]
+        input_hash = renditions_input_hash(image, segment, i, renditions)
         
-        temp_dir = Path(config['temp_dir'])
-        temp_dir.mkdir(exist_ok=True)
+        if manifest.completed_clip(i, input_hash, clip_files):
+            for clip_list, clip_file in zip(clip_lists, clip_files):
+                clip_list.append(str(clip_file))
+            print(f"Reusing professional clip {i+1}/{start_index + len(segments)}")
+            continue
         
-        print(f"Processing {len(segments)} segments for professional video...")
+        manifest.record_clip(i, state='rendering', input_hash=input_hash, path=str(clip_files[0]),
+                             paths=[str(clip_file) for clip_file in clip_files])
+        success, attempts, error = render_clip_with_retries(image, segment, i, clip_files, renditions)
         
-        # Create individual clips with professional effects
-        clip_files = []
-        for i, (segment, image_file) in enumerate(zip(segments, images)):
-            clip_file = temp_dir / f"professional_clip_{i}.mp4"
-            
-            # Extract quote text and number
-            display_text = segment.replace('"', '').replace("'", "'")
-            number_text = str(i + 1)
-            
-            # Clean text for quotes - extract quote part if format is "Quote one: text"
-            if ':' in display_text:
-                parts = display_text.split(':', 1)
-                if len(parts) > 1:
-                    display_text = parts[1].strip()
-            
-            # Limit text length for readability
-            if len(display_text) > 120:
-                display_text = display_text[:120] + '...'
-            
-            # Professional FFmpeg command with advanced effects
-            ffmpeg_cmd = [
-                'ffmpeg', '-y',
-                '-loop', '1', '-i', str(image_file),
-                '-t', str(segment_duration),
-                '-vf', (
-                    f"scale={width*1.1}:{height*1.1}:force_original_aspect_ratio=increase,"
-                    f"crop={width}:{height}:(iw-ow)/2:(ih-oh)/2,"
-                    f"drawtext=text='{number_text}':fontsize=140:fontcolor=white:borderw=8:bordercolor=black@0.9:"
-                    f"x=(w-text_w)/2:y=h*0.12:enable='gte(t,0.3)':alpha='min(1\\,max(0\\,(t-0.3)*4))':"
-                    f"fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf,"
-                    f"drawtext=text='{display_text}':fontsize=68:fontcolor=white:borderw=5:bordercolor=black@0.85:"
-                    f"x=(w-text_w)/2:y=(h-text_h)/2+20:enable='gte(t,0.8)':alpha='min(1\\,max(0\\,(t-0.8)*3))':"
-                    f"fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf,"
-                    f"drawtext=text='{display_text}':fontsize=68:fontcolor=black@0.4:"
-                    f"x=(w-text_w)/2+4:y=(h-text_h)/2+24:enable='gte(t,0.85)':alpha='min(0.7\\,max(0\\,(t-0.85)*4))':"
-                    f"fontfile=/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
-                ),
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-crf', '18',  # High quality
-                '-pix_fmt', 'yuv420p',
-                '-r', '30',
-                str(clip_file)
-            ]
-            
-            result = subprocess.run(ffmpeg_cmd, capture_output=True, text=True)
-            if result.returncode != 0:
-                print(f"Error creating clip {i}: {result.stderr}")
-                continue
-                
-            clip_files.append(str(clip_file))
-            print(f"Created professional clip {i+1}/{len(segments)}")
+        if not success:
+            manifest.record_clip(i, state='failed', attempts=attempts, error=error, output_hash=None)
+            if strict:
+                raise Exception(f"Clip {i} failed after {attempts} attempts: {error}")
+            print(f"Warning: skipping clip {i}, the video will be missing segment {i+1}")
+            continue
         
-        if not clip_files:
-            raise Exception("No clips were created successfully")
+        output_hash = combined_hash([file_sha256(clip_file) for clip_file in clip_files])
+        manifest.record_clip(i, state='done', attempts=attempts, error=None, output_hash=output_hash)
+        for clip_list, clip_file in zip(clip_lists, clip_files):
+            clip_list.append(str(clip_file))
+        print(f"Created professional clip {i+1}/{start_index + len(segments)}")
+    
+    return clip_lists
+
+def render_segment_clips(segments, images, settings, temp_dir, start_index=0, manifest=None):
+    """Single-rendition render_segment_renditions, returns the created clip paths"""
+    return render_segment_renditions(segments, images, [settings], temp_dir, start_index, manifest)[0]
+
+def render_shard(config):
+    """
+    Renders a contiguous slice of a job's segments into a single stream-copied file.
+    Config holds the job's render options plus 'start_index' and 'output_path';
+    any missing clip fails the shard so the coordinator can retry it.
+    """
+    segments = config['segments']
+    settings = dict(render_settings(config), strict=True)
+    
+    with job_workspace(config) as temp_dir:
+        clip_files = render_segment_clips(
+            segments, config['images'], settings, temp_dir, config.get('start_index', 0)
+        )
+        if len(clip_files) != len(segments):
+            raise Exception(f"Shard rendered {len(clip_files)} of {len(segments)} clips")
         
-        # Create concat file for smooth merging
         concat_file = temp_dir / "concat_list.txt"
-        with open(concat_file, 'w') as f:
-            for clip_file in clip_files:
-                f.write(f"file '{clip_file}'\n")
+        write_concat_list(clip_files, concat_file)
         
-        # Final assembly with professional encoding
-        final_cmd = [
+        result = run_ffmpeg([
             'ffmpeg', '-y',
             '-f', 'concat',
             '-safe', '0',
-            '-i', str(concat_file)
-        ]
-        
-        # Add audio if provided
-        if audio_file and os.path.exists(audio_file):
-            final_cmd.extend(['-i', audio_file])
-            final_cmd.extend(['-c:a', 'aac', '-b:a', '128k', '-shortest'])
-        
-        # Professional video encoding settings
-        final_cmd.extend([
-            '-c:v', 'libx264',
-            '-preset', 'medium',
-            '-crf', '18',  # High quality
-            '-pix_fmt', 'yuv420p',
-            '-movflags', '+faststart',  # Optimize for web streaming
-            '-r', '30',
-            str(output_path)
+            '-i', str(concat_file),
+            '-c', 'copy',
+            str(config['output_path'])
         ])
-        
-        print("Assembling final professional video...")
-        result = subprocess.run(final_cmd, capture_output=True, text=True)
-        
         if result.returncode != 0:
-            raise Exception(f"Final assembly failed: {result.stderr}")
+            raise Exception(f"Shard concat failed: {result.stderr}")
+    
+    return config['output_path']
+
+def job_already_complete(manifest, segments, images, renditions):
+    """True when the manifest's finished outputs still match the files on disk and the job inputs"""
+    assembly = manifest.data['assembly']
+    output_paths = [settings['output_path'] for settings in renditions]
+    if assembly.get('state') != 'done' or not all(os.path.exists(path) for path in output_paths):
+        return False
+    output_hash = combined_hash([file_sha256(path) for path in output_paths])
+    if assembly.get('clip_count') != len(segments) or output_hash != assembly.get('output_hash'):
+        return False
+    return all(
+        manifest.clip(i).get('input_hash') == renditions_input_hash(image, segment, i, renditions)
+        for i, (segment, image) in enumerate(zip(segments, images))
+    )
+
+def render_professional_video(config):
+    """
+    Renders a video from an in-memory config dict.
+    Images may be file paths, data URIs, encoded bytes or decoded RGB frames,
+    so an in-process caller can hand generated images straight to the encoder.
+    With 'renditions' every output size is encoded in the same pass (see rendition_settings).
+    Progress is recorded in a job manifest ('manifest_path', by default next to
+    the output when 'resume' is set); a resumed job re-encodes only missing clips.
+    """
+    segments = config['segments']
+    images = config['images']
+    audio_file = config.get('audio_file')
+    renditions = rendition_settings(config)
+    output_paths = [settings['output_path'] for settings in renditions]
+    
+    manifest_path = config.get('manifest_path')
+    if not manifest_path and config.get('resume'):
+        manifest_path = f"{config['output_path']}.manifest.json"
+    manifest = JobManifest(manifest_path)
+    
+    if config.get('resume') and job_already_complete(manifest, segments, images, renditions):
+        print(f"Job already complete, nothing to resume: {', '.join(output_paths)}")
+        return True
+    
+    with job_workspace(config) as temp_dir:
+        print(f"Processing {len(segments)} segments for {renditions[0]['mode']} video in {len(renditions)} rendition(s)...")
+        manifest.data.update(job_id=config.get('job_id'), workspace=str(temp_dir), segment_count=len(segments))
+        manifest.save()
         
-        # Cleanup temporary files
-        for clip_file in clip_files:
-            try:
-                os.remove(clip_file)
-            except:
-                pass
+        # Create individual clips with professional effects
+        clip_lists = render_segment_renditions(segments, images, renditions, temp_dir, manifest=manifest)
         
+        if not clip_lists[0]:
+            raise Exception("No clips were created successfully")
+        
+        # Assemble next to the clips first so a crash never leaves a truncated output
+        assembled_files = [
+            temp_dir / f"assembled{'_' + settings['name'] if settings['name'] else ''}{Path(settings['output_path']).suffix or '.mp4'}"
+            for settings in renditions
+        ]
+        manifest.record_assembly(state='rendering', clip_count=len(clip_lists[0]))
         try:
-            os.remove(concat_file)
-        except:
-            pass
+            assemble_renditions(clip_lists, temp_dir, audio_file, assembled_files, renditions)
+        except Exception as e:
+            manifest.record_assembly(state='failed', error=str(e)[-500:])
+            raise
+        for assembled_file, output_path in zip(assembled_files, output_paths):
+            shutil.move(str(assembled_file), str(output_path))
+        output_hash = combined_hash([file_sha256(path) for path in output_paths])
+        manifest.record_assembly(state='done', error=None, output_hash=output_hash)
+    
+    print(f"Professional video created successfully: {', '.join(output_paths)}")
+    return True
+
+def create_professional_video(config_file_path):
+    """
+    Creates a professional video with advanced FFmpeg features
+    Config should contain: segments, images, audio, output_path, dimensions
+    Optional: temp_dir, use_ram_disk, min_free_bytes, keep_on_failure, job_id,
+    mode ('final' or 'draft'), draft_seconds, clip_retries, retry_backoff,
+    strict (default true), resume, manifest_path, renditions (list of
+    {width, height, name, output_path, crf, video_bitrate, audio_bitrate})
+    Images may be file paths or base64 data URIs
+    """
+    try:
+        # Load configuration
+        with open(config_file_path, 'r') as f:
+            config = json.load(f)
         
-        print(f"Professional video created successfully: {output_path}")
-        return True
+        return render_professional_video(config)
         
     except Exception as e:
         print(f"Error in professional video creation: {str(e)}")